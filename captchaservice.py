@@ -1,11 +1,12 @@
 import io
 import logging
-import requests
 import base64
+import hashlib
 import utils
 from PIL import Image
 from abc import ABCMeta
 from abc import abstractmethod
+from queue import Full
 from queue import Queue
 from threading import Thread
 from southocr import southocr
@@ -13,6 +14,9 @@ from southocr import southocr
 
 class AbstractCaptchaService(metaclass=ABCMeta):
     
+    ocr_cache_size = 4096  # maximum number of solved captcha images to remember
+    request_timeout = utils.SessionHelper.request_timeout
+    
     @abstractmethod
     def _add_captcha_to_pool(self):
         """
@@ -27,7 +31,40 @@ class AbstractCaptchaService(metaclass=ABCMeta):
         self._max_pool_size = maxsize
         self._captcha_result_pool = Queue(maxsize)  # Stores captcha results. Concrete structure not defined.
         self._threads = [Thread(target=self._add_captcha_to_pool, name='CaptchaService-worker-%s' % i) for i in range(worker_count)]
+        self._session = utils.SessionHelper.create_session(worker_count)
+        self._ocr_cache = {}  # image digest -> code. Single dict operations are atomic, so no lock is needed.
         self._running = False
+        
+    def _solve(self, img: Image) -> str:
+        """
+        Solves a captcha image, reusing the result if the same image has been solved before.
+        :param img: The captcha image
+        :return: The code, or None if the image cannot be solved
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(('%s %s' % (img.mode, img.size)).encode())
+        digest.update(img.tobytes())
+        key = digest.digest()
+        code = self._ocr_cache.get(key)
+        if code is None:
+            code = southocr.solve(img)
+            if code and len(self._ocr_cache) < self.ocr_cache_size:
+                self._ocr_cache[key] = code
+        return code
+        
+    def _put_to_pool(self, captcha_result) -> bool:
+        """
+        Puts a captcha result into the pool, blocking while the pool is full. Gives up when the service shuts down.
+        :param captcha_result: The captcha result to put
+        :return: True if the result was put into the pool
+        """
+        while self._running:
+            try:
+                self._captcha_result_pool.put(captcha_result, timeout=1.0)
+                return True
+            except Full:
+                pass
+        return False
             
     def start(self):
         if not self._running:
@@ -75,39 +112,38 @@ class NoCaptchaService(AbstractCaptchaService):
     
 class SouthEnrollmentCaptchaService(AbstractCaptchaService):
     
+    captcha_url = 'http://service.southcn.com/ksy/?c=vericode&a=simple'
+    
     def _get_captcha_from_remote(self) -> (Image, dict):
         """
         Gets a new captcha image with its 't' argument from the remote.
         The 't' argument is used when sending enquiry request to the server.
         :return: (img: PIL.Image, t: str)
         """
-        response = requests.get('http://service.southcn.com/ksy/?c=vericode&a=simple')
+        response = self._session.get(SouthEnrollmentCaptchaService.captcha_url, timeout=self.request_timeout)
         cookies = response.cookies
         self._logger.debug('Got captcha from remote')
-        img_bytes = b''
-        for chunk in response.iter_content(chunk_size=2048):
-            img_bytes += chunk
-        img = Image.open(io.BytesIO(img_bytes))
+        img = Image.open(io.BytesIO(response.content))
         
         return img, cookies
     
     @utils.MultithreadingHelper.wrapped
     def _add_captcha_to_pool(self):
+        debug = self._logger.isEnabledFor(logging.DEBUG)
         while self._running:
-            with self._captcha_result_pool.not_full:
-                pass  # We only want to fetch new code when the pool is not full(approx).
-            if not self._running:
-                return
-            self._logger.debug('Preparing to add captcha to pool; current size: %d', self._captcha_result_pool.qsize())
+            if debug:  # qsize() takes the pool's lock, so skip it entirely when nobody will see the message
+                self._logger.debug('Preparing to add captcha to pool; current size: %d', self._captcha_result_pool.qsize())
             code = None
             while not code:
                 try:
                     img, cookies = self._get_captcha_from_remote()
-                    code = southocr.solve(img)
+                    code = self._solve(img)
                 except Exception:
                     self._logger.exception('Error executing _add_captcha_to_pool')
-            self._captcha_result_pool.put((code, cookies))
-            self._logger.debug('Adding captcha to pool: %s, %s', code, cookies)
+            if not self._put_to_pool((code, cookies)):  # Blocks while the pool is full
+                return
+            if debug:
+                self._logger.debug('Added captcha to pool: %s, %s', code, cookies)
     
     def __init__(self, worker_count: int, maxsize: int = 40):
         super().__init__(worker_count)
@@ -122,13 +158,15 @@ class SouthEnrollmentCaptchaService(AbstractCaptchaService):
 
 class SouthCaptchaService(AbstractCaptchaService):
     
+    captcha_url = 'http://94.gaokao.southcn.com/?c=core&a=call&_m=gaokao.code'
+    
     def _get_captcha_from_remote(self) -> (Image, str):
         """
         Gets a new captcha image with its 't' argument from the remote.
         The 't' argument is used when sending enquiry request to the server.
         :return: (img: PIL.Image, t: str)
         """
-        json_body = requests.get('http://94.gaokao.southcn.com/?c=core&a=call&_m=gaokao.code').json()
+        json_body = self._session.get(SouthCaptchaService.captcha_url, timeout=self.request_timeout).json()
         self._logger.debug('Got captcha json from remote: %s', json_body)
         t = json_body['args']['t']
         img_bytes = base64.standard_b64decode(json_body['args']['p'])
@@ -138,21 +176,21 @@ class SouthCaptchaService(AbstractCaptchaService):
 
     @utils.MultithreadingHelper.wrapped
     def _add_captcha_to_pool(self):
+        debug = self._logger.isEnabledFor(logging.DEBUG)
         while self._running:
-            with self._captcha_result_pool.not_full:
-                pass  # We only want to fetch new code when the pool is not full(approx).
-            if not self._running:
-                return
-            self._logger.debug('Preparing to add captcha to pool; current size: %d', self._captcha_result_pool.qsize())
+            if debug:  # qsize() takes the pool's lock, so skip it entirely when nobody will see the message
+                self._logger.debug('Preparing to add captcha to pool; current size: %d', self._captcha_result_pool.qsize())
             code = None
             while not code:
                 try:
                     img, t = self._get_captcha_from_remote()
-                    code = southocr.solve(img)
+                    code = self._solve(img)
                 except Exception:
                     self._logger.exception('Error executing _add_captcha_to_pool')
-            self._captcha_result_pool.put((code, t))
-            self._logger.debug('Adding captcha to pool: %s, %s', code, t)
+            if not self._put_to_pool((code, t)):  # Blocks while the pool is full
+                return
+            if debug:
+                self._logger.debug('Added captcha to pool: %s, %s', code, t)
     
     def __init__(self, worker_count: int, maxsize: int=40):
         super().__init__(worker_count)
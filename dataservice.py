@@ -1,23 +1,29 @@
-import requests
 import utils
 import logging
 import concurrent.futures
-import re
-import ast
 import csv
 import threading
+import time
 from abc import abstractmethod
 from abc import ABCMeta
 from concurrent.futures import ThreadPoolExecutor
-from copy import deepcopy
 
-from collections import Iterable
+from collections.abc import Iterable
+from collections.abc import Sized
 
 from captchaservice import SouthCaptchaService
 from captchaservice import SouthEnrollmentCaptchaService
 from captchaservice import NoCaptchaService
 
 
+# Outcomes of a single query, returned by _fetch0 of the South data services along with the result map
+FETCH_OK = 0
+FETCH_INVALID_CAPTCHA = 1
+FETCH_INVALID_SID = 2
+FETCH_INVALID_YMOB = 3
+FETCH_FAILED = 4  # No valid response was received; the query should be retried
+
+
 class KnownException(BaseException):
     pass
     
@@ -28,14 +34,21 @@ class UnknownResponseException(BaseException):
 
 class AbstractDataService(metaclass=ABCMeta):
     
+    request_timeout = utils.SessionHelper.request_timeout
+    retry_delay = 0.5  # seconds to wait before retrying a failed request in place
+    
     def __init__(self, worker_count: int, captcha_service, query_supplier):
         self._logger = logging.getLogger(__name__)
         self._worker_count = worker_count
         self._captcha_service = captcha_service
         self._query_supplier = query_supplier
         self._results = []
+        self._results_lock = threading.Lock()
         self._futures = []
+        self._pending_futures = set()  # futures in self._futures that are not done yet
+        self._futures_lock = threading.Lock()
         self._thread_pool_executor = ThreadPoolExecutor(worker_count)
+        self._session = utils.SessionHelper.create_session(worker_count)
         self._running = False
         
     @abstractmethod
@@ -47,10 +60,46 @@ class AbstractDataService(metaclass=ABCMeta):
         """
         raise NotImplementedError
     
+    @staticmethod
+    def _is_single_query_set(query_set: Iterable) -> bool:
+        """
+        Tells whether a query set is known to hold exactly one query. Such a set can be retried in place by the
+        worker instead of being resubmitted to the executor.
+        :param query_set: The query set to check
+        :return: True if the query set is sized and has one item
+        """
+        return isinstance(query_set, Sized) and len(query_set) == 1
+    
+    def _submit(self, fn, *args):
+        """
+        Submits a task to the thread pool and keeps track of its future.
+        :return: The future of the task
+        """
+        future = self._thread_pool_executor.submit(fn, *args)
+        with self._futures_lock:
+            self._futures.append(future)
+            self._pending_futures.add(future)
+        future.add_done_callback(self._discard_pending_future)
+        return future
+    
+    def _discard_pending_future(self, future):
+        with self._futures_lock:
+            self._pending_futures.discard(future)
+    
     def _add_result(self, result):
-        self._results.append(result)
+        with self._results_lock:
+            self._results.append(result)
         # TODO: implement callbacks
         
+    def _add_results(self, results: list):
+        """
+        Adds a batch of results at once, taking the results lock only once for the whole batch.
+        :param results: The results to add
+        :return: None
+        """
+        with self._results_lock:
+            self._results.extend(results)
+        
     def add_new_data_callback(self, fn):
         raise NotImplementedError
     
@@ -58,8 +107,14 @@ class AbstractDataService(metaclass=ABCMeta):
         raise NotImplementedError
     
     def get_result_list(self, copy=True):
+        """
+        Gets the results obtained so far.
+        :param copy: If True, return a copy of the list with a shallow copy of each entry. Entries are flat maps of
+        immutable values, so this is enough to let the caller modify them freely.
+        :return: A list of result maps
+        """
         if copy:
-            return deepcopy(self._results)
+            return [entry.copy() for entry in self._results]
         else:
             return self._results
     
@@ -69,8 +124,7 @@ class AbstractDataService(metaclass=ABCMeta):
             self._captcha_service.start()
             self._running = True
             for qs in self._query_supplier.get_query_sets():
-                future = self._thread_pool_executor.submit(self._fetch, qs)
-                self._futures.append(future)
+                self._submit(self._fetch, qs)
             self._logger.debug('DataService started')
         else:
             self._logger.warning('Illegal state: DataService already started')
@@ -82,23 +136,21 @@ class AbstractDataService(metaclass=ABCMeta):
             self._captcha_service.shutdown()
             self._thread_pool_executor.shutdown(wait=wait)
             if wait:
-                concurrent.futures.wait(self._futures)
+                self.wait()
             self._logger.debug('DataService stopped')
         else:
             self._logger.warning('Illegal state: DataService already stopped')
             
     def wait(self):
         self._logger.debug('wait() called')
-        # When a new future is added to the list due to error & retry, we need to wait again.
-        done = False
-        while not done:
-            try:
-                concurrent.futures.wait(self._futures)
-            except ValueError:
-                self._logger.debug("ValueError occurred during waiting; should be a result of future list's refreshment")
-                pass
-            else:
-                done = True
+        # When a new future is added due to error & retry, it is still pending by the time the future that added it
+        # finishes, so waiting until no future is pending also covers retries.
+        while True:
+            with self._futures_lock:
+                pending = set(self._pending_futures)
+            if not pending:
+                break
+            concurrent.futures.wait(pending)
         self._logger.debug('waiting ended')
         
     @property
@@ -115,8 +167,8 @@ class LocalDataService(AbstractDataService):
     This data service reads local file(s) and serves the data in them.
     """
     
-    log_entry_regex = re.compile('Successfully added entry: (.*)$')
-    number_regex = re.compile('[\d.-]+')
+    log_entry_marker = 'Successfully added entry: '
+    result_batch_size = 1000  # number of parsed entries to buffer before adding them to the results
     
     def __init__(self, worker_count: int, *files, encoding=None, entry_filter=None):
         """
@@ -132,8 +184,7 @@ class LocalDataService(AbstractDataService):
             self._entry_filter = lambda x: True
         else:
             self._entry_filter = entry_filter
-        self._sid_set = set()  # used for duplication removal purpose
-        self._sid_set_lock = threading.Lock()
+        self._seen_sids = {}  # used for duplication removal purpose; only the keys matter
             
     def _fetch(self, query_set: Iterable):
         pass
@@ -147,77 +198,125 @@ class LocalDataService(AbstractDataService):
         """
         if value == '':
             return None
-        elif LocalDataService.number_regex.match(value):
+        try:
             return float(value)
-        else:
+        except ValueError:
             return value
         
-    def _sid_unique(self, sid: str) -> bool:
-        with self._sid_set_lock:
-            return sid not in self._sid_set
+    @staticmethod
+    def _convert_text(value: str) -> object:
+        """
+        Converts an empty string to None. Other strings are not converted.
+        :param value: The value to convert
+        :return: The converted value
+        """
+        return value if value != '' else None
+        
+    @staticmethod
+    def _convert_sid(value: str) -> str:
+        return value.zfill(10)
+    
+    @staticmethod
+    def _convert_ymob(value: str) -> str:
+        return value.zfill(4)
+        
+    def _claim_sid(self, sid: str) -> bool:
+        """
+        Marks an SID as added, unless it already is. dict.setdefault is atomic in CPython, so the check and the
+        insertion cannot interleave between parser threads and no lock is needed.
+        :param sid: The SID to claim
+        :return: True if the SID was not added before
+        """
+        token = object()
+        return self._seen_sids.setdefault(sid, token) is token
     
     @utils.MultithreadingHelper.wrapped
     def _parse_log_file(self, fle):
         self._logger.info('Parsing log file %s', fle.name)
         expected_result_len = len(utils.FieldsHelper.basic_field_names)
+        batch = []
         for line_i, line in enumerate(fle):
             line_no = line_i + 1
             try:
-                match = LocalDataService.log_entry_regex.search(line)
-                if not match:
+                marker_index = line.find(LocalDataService.log_entry_marker)
+                if marker_index < 0:
                     continue
-                dict_str = match.group(1)
-                entry_map = ast.literal_eval(dict_str)
+                dict_str = line[marker_index + len(LocalDataService.log_entry_marker):].rstrip()
+                entry_map = utils.DataStructureHelper.load_result_map(dict_str)
                 if len(entry_map) != expected_result_len:
                     self._logger.error('Entry with wrong length at %s:%d: %s', fle.name, line_no, dict_str)
                 sid = entry_map['sid']
-                if not self._sid_unique(sid):
+                if not self._claim_sid(sid):
                     self._logger.info('SID %s already added. Discarding %s:%d', sid, fle.name, line_no)
                 else:
-                    self._sid_set.add(sid)
-                    self._add_result(entry_map)
-                    self._logger.info('Successfully added entry: %s', entry_map)
+                    batch.append(entry_map)
+                    self._logger.info('Successfully added entry: %s', utils.DataStructureHelper.dump_result_map(entry_map))
+                    if len(batch) >= self.result_batch_size:
+                        self._add_results(batch)
+                        batch = []
             except Exception:
                 self._logger.exception('Error occurred parsing log file %s, line %d', fle.name, line_no)
+        self._add_results(batch)
 
     @utils.MultithreadingHelper.wrapped
     def _parse_csv_file(self, fle):
         self._logger.info('Parsing csv file %s', fle.name)
         expected_result_len = len(utils.FieldsHelper.basic_field_names)
         reader = csv.reader(fle)
-        rows = [x for x in reader]
+        rows = list(reader)
         column_names = rows[0]
         column_names = [utils.FieldsHelper.get_field_key_by_name(x) for x in column_names]
         self._logger.debug('Columns in csv file %s: %s', fle.name, column_names)
-        data_rows = rows[1:]
-        for line_i, row in enumerate(data_rows):
+        # Decide once per file how each column is read, rather than dispatching on the column key for every cell.
+        converters = []  # item: (column_index, key, converter)
+        for ci, key in enumerate(column_names):
+            if not key:  # We don't read in ranking/average data.
+                continue
+            if key == 'sid':
+                converter = LocalDataService._convert_sid
+            elif key == 'ymob':
+                converter = LocalDataService._convert_ymob
+            elif key in utils.FieldsHelper.rankable_fields:
+                converter = LocalDataService._convert_value
+            else:  # Text fields such as name and major are kept as they are, even if float() would accept them
+                converter = LocalDataService._convert_text
+            converters.append((ci, key, converter))
+        if len({key for _, key, _ in converters}) != expected_result_len:
+            self._logger.error('Unexpected columns in csv file %s: %s', fle.name, column_names)
+            return
+        sid_index = column_names.index('sid')
+        column_count = len(column_names)
+        min_row_len = converters[-1][0] + 1  # Trailing ranking/average cells may be missing
+        debug = self._logger.isEnabledFor(logging.DEBUG)
+        # First pick the rows to add, then convert the remaining values column by column.
+        accepted_rows = []
+        for line_i, row in enumerate(rows[1:]):
             line_no = line_i + 1
-            unique = False
-            result = {}
-            for ri in range(len(row)):
-                key = column_names[ri]
-                if not key:  # We don't read in ranking/average data.
-                    continue
-                value = row[ri]
-                if key == 'sid':
-                    sid = value.zfill(10)
-                    if not unique:
-                        if not self._sid_unique(sid):
-                            self._logger.debug('SID %s already added. Discarding %s:%d', sid, fle.name, line_no)
-                            break
-                        unique = True
-                        self._sid_set.add(sid)
-                    result[key] = sid
-                elif key == 'ymob':
-                    result[key] = value.zfill(4)
-                else:
-                    result[key] = LocalDataService._convert_value(value)
-            if unique:
-                if len(result) != expected_result_len:
-                    self._logger.error('Entry with wrong length at %s:%d: %s', fle.name, line_no, row)
-                else:
-                    self._add_result(result)
-                    self._logger.info('Successfully added entry: %s', result)
+            if not row:
+                continue
+            if not min_row_len <= len(row) <= column_count:
+                self._logger.error('Entry with wrong length at %s:%d: %s', fle.name, line_no, row)
+                continue
+            sid = LocalDataService._convert_sid(row[sid_index])
+            if not self._claim_sid(sid):
+                if debug:
+                    self._logger.debug('SID %s already added. Discarding %s:%d', sid, fle.name, line_no)
+                continue
+            accepted_rows.append(row)
+        if not accepted_rows:
+            return
+        columns = list(zip(*accepted_rows))
+        keys = [key for _, key, _ in converters]
+        converted_columns = [list(map(converter, columns[ci])) for ci, _, converter in converters]
+        batch = []
+        for values in zip(*converted_columns):
+            result = dict(zip(keys, values))
+            batch.append(result)
+            self._logger.info('Successfully added entry: %s', utils.DataStructureHelper.dump_result_map(result))
+            if len(batch) >= self.result_batch_size:
+                self._add_results(batch)
+                batch = []
+        self._add_results(batch)
     
     @utils.MultithreadingHelper.wrapped
     def _parse_file(self, filename: str):
@@ -233,9 +332,12 @@ class LocalDataService(AbstractDataService):
         if not self._running:
             self._logger.debug('DataService starting')
             self._running = True
-            for fle in self._files:
-                future = self._thread_pool_executor.submit(self._parse_file, fle)
-                self._futures.append(future)
+            if len(self._files) == 1:
+                # Parsing is CPU-bound and gains nothing from another thread; this also makes wait() return at once
+                self._parse_file(self._files[0])
+            else:
+                for fle in self._files:
+                    self._submit(self._parse_file, fle)
             self._logger.debug('DataService started')
         else:
             self._logger.warning('Illegal state: DataService already started')
@@ -246,32 +348,19 @@ class LocalDataService(AbstractDataService):
             self._running = False
             self._thread_pool_executor.shutdown(wait=wait)
             if wait:
-                concurrent.futures.wait(self._futures)
+                self.wait()
             self._logger.debug('DataService stopped')
         else:
             self._logger.warning('Illegal state: DataService already stopped')
-
-    def wait(self):
-        self._logger.debug('wait() called')
-        # When a new future is added to the list due to error & retry, we need to wait again.
-        done = False
-        while not done:
-            try:
-                concurrent.futures.wait(self._futures)
-            except ValueError:
-                self._logger.debug(
-                    "ValueError occurred during waiting; should be a result of future list's refreshment")
-                pass
-            else:
-                done = True
-        self._logger.debug('waiting ended')
         
         
 class SouthEnrollmentDataService(AbstractDataService):
     
+    query_url = 'http://service.southcn.com/ksy/?c=core&a=call&_m=gklq.search'
+    
     class InvalidCaptchaException(KnownException):
         """
-        Raised when json return code is -1.
+        Json return code -1. _fetch0 reports it as FETCH_INVALID_CAPTCHA.
         """
         def __init__(self, correct_code=None):
             self._correct_code = correct_code  # Due to a server bug, we can extract the correct verification code in the responses(fixed since 14 Jul)
@@ -283,13 +372,13 @@ class SouthEnrollmentDataService(AbstractDataService):
     
     class InvalidSIDException(KnownException):
         """
-        Raised when json return code is -2.
+        Json return code -2. _fetch0 reports it as FETCH_INVALID_SID.
         """
         pass
     
     class InvalidYMOBException(KnownException):
         """
-        Raised when json return code is -3.
+        Json return code -3. _fetch0 reports it as FETCH_INVALID_YMOB.
         """
     
     def __init__(self, worker_count: int, query_supplier, captcha_service: SouthCaptchaService=None, captcha_worker_count: int=2):
@@ -307,24 +396,28 @@ class SouthEnrollmentDataService(AbstractDataService):
             return utils.DataStructureHelper.construct_enrollment_result_map(sid, '暂无', ymob, '暂无', '暂无', '暂无', '暂无')
     
     def _fetch0(self, sid, ymob, code, cookies):
+        """
+        Makes one query. Expected failures are returned rather than raised, as they are frequent on the retry path.
+        :return: (outcome: one of the FETCH_* constants, result_map: dict if outcome is FETCH_OK, else None)
+        """
         json_body = None
         try:
-            json_body = requests.get(
-                'http://service.southcn.com/ksy/?c=core&a=call&_m=gklq.search&zkzh=%s&csrq=%s&code=%s'
-                % (sid, ymob, code), cookies=cookies).json()
+            json_body = self._session.get(SouthEnrollmentDataService.query_url,
+                                          params={'zkzh': sid, 'csrq': ymob, 'code': code},
+                                          cookies=cookies, timeout=self.request_timeout).json()
         except Exception as ex:
             self._logger.error('Error occurred fetching data for %s, %s, %s, %s: %s', sid, ymob, code, cookies, ex)
-            raise RuntimeError
+            return FETCH_FAILED, None
         status = json_body['code']
         if status == -3:
-            raise SouthEnrollmentDataService.InvalidYMOBException()
+            return FETCH_INVALID_YMOB, None
         elif status == 1 or status == -4:
-            return self._parse_json(json_body, sid, ymob)
+            return FETCH_OK, self._parse_json(json_body, sid, ymob)
         elif status == -1:
-            # raise SouthEnrollmentDataService.InvalidCaptchaException(json_body['debug']['vrd'])
-            raise SouthEnrollmentDataService.InvalidCaptchaException()
+            # Correct code used to be available in json_body['debug']['vrd']
+            return FETCH_INVALID_CAPTCHA, None
         elif status == -2:
-            raise SouthEnrollmentDataService.InvalidSIDException()
+            return FETCH_INVALID_SID, None
         else:
             raise UnknownResponseException(json_body)
     
@@ -332,6 +425,7 @@ class SouthEnrollmentDataService(AbstractDataService):
     def _fetch(self, query_set: Iterable):
         if not self._running:
             return
+        debug = self._logger.isEnabledFor(logging.DEBUG)
         code, cookies = self._captcha_service.get_captcha_result()
         q_sid = None
         # captcha_extracted = False
@@ -350,34 +444,37 @@ class SouthEnrollmentDataService(AbstractDataService):
                     if not captcha_valid:
                         code, cookies = self._captcha_service.get_captcha_result()
                         captcha_valid = True
-                    self._logger.debug('Trying to fetch: %s, %s, %s, %s', sid, ymob, code, cookies)
-                    result_map = self._fetch0(sid, ymob, code, cookies)
-                    self._add_result(result_map)
-                    self._logger.info('Successfully added entry: %s', result_map)
-                    return
-                except SouthEnrollmentDataService.InvalidYMOBException:
-                    self._logger.debug('Invalid YMOB: %s, %s', sid, ymob)
-                    skip = True
-                except SouthEnrollmentDataService.InvalidSIDException:
-                    self._logger.warning('Invalid SID: %s', sid)
-                    return
-                # except SouthEnrollmentDataService.InvalidCaptchaException as ex:
-                    # if not captcha_extracted:
-                    #     self._logger.debug('Invalid captcha: %s, %s; extracting from response', code, cookies)
-                    #     code = ex.correct_code
-                    #     captcha_extracted = True
-                    # else:
-                    #     self._logger.warning('Still invalid captcha from response! Code & cookies: %s, %s; re-getting from pool', code, cookies)
-                    #     code, cookies = self._captcha_service.get_captcha_result()
-                    #     captcha_extracted = False
-                except SouthEnrollmentDataService.InvalidCaptchaException:
-                    self._logger.debug('Invalid captcha: %s, %s', code, cookies)
-                    captcha_valid = False
-                except RuntimeError:
-                    self._logger.info('Re-adding task for %s, %s', sid, ymob)
-                    future = self._thread_pool_executor.submit(self._fetch, query_set)
-                    self._futures.append(future)
-                    return
+                    if debug:
+                        self._logger.debug('Trying to fetch: %s, %s, %s, %s', sid, ymob, code, cookies)
+                    outcome, result_map = self._fetch0(sid, ymob, code, cookies)
+                    if outcome == FETCH_OK:
+                        self._add_result(result_map)
+                        self._logger.info('Successfully added entry: %s', utils.DataStructureHelper.dump_result_map(result_map))
+                        return
+                    elif outcome == FETCH_INVALID_YMOB:
+                        if debug:
+                            self._logger.debug('Invalid YMOB: %s, %s', sid, ymob)
+                        skip = True
+                    elif outcome == FETCH_INVALID_SID:
+                        self._logger.warning('Invalid SID: %s', sid)
+                        return
+                    elif outcome == FETCH_INVALID_CAPTCHA:
+                        if debug:
+                            self._logger.debug('Invalid captcha: %s, %s', code, cookies)
+                        captcha_valid = False
+                    else:  # FETCH_FAILED
+                        if not self._running:
+                            return
+                        if self._is_single_query_set(query_set):
+                            self._logger.info('Retrying %s, %s', sid, ymob)
+                            time.sleep(self.retry_delay)
+                            continue
+                        self._logger.info('Re-adding task for %s, %s', sid, ymob)
+                        try:
+                            self._submit(self._fetch, query_set)
+                        except RuntimeError:  # The executor has been shut down in the meantime
+                            self._logger.warning('DataService stopped; dropping task for %s, %s', sid, ymob)
+                        return
                 except Exception:
                     self._logger.exception('Error fetching or adding data')
         self._logger.warning('No valid YMOB for SID %s', q_sid)
@@ -385,21 +482,23 @@ class SouthEnrollmentDataService(AbstractDataService):
 
 class SouthDataService(AbstractDataService):
     
+    query_url = 'http://94.gaokao.southcn.com/?c=core&a=call&_m=gaokao.search'
+    
     class InvalidCaptchaException(KnownException):
         """
-        Raised when json return code is -2.
+        Json return code -2. _fetch0 reports it as FETCH_INVALID_CAPTCHA.
         """
         pass
     
     class InvalidSIDException(KnownException):
         """
-        Raised when json return code is -3.
+        Json return code -3. _fetch0 reports it as FETCH_INVALID_SID.
         """
         pass
     
     class InvalidYMOBException(KnownException):
         """
-        Raised when json return code is -4.
+        Json return code -4. _fetch0 reports it as FETCH_INVALID_YMOB.
         """
     
     def __init__(self, worker_count: int, query_supplier, captcha_service: SouthCaptchaService=None, captcha_worker_count: int=2):
@@ -436,23 +535,27 @@ class SouthDataService(AbstractDataService):
         return utils.DataStructureHelper.construct_result_map(args['zkzh'], args['xm'], ymob, major, chn, mth, eng, com, sum)
     
     def _fetch0(self, sid, ymob, code, t):
+        """
+        Makes one query. Expected failures are returned rather than raised, as they are frequent on the retry path.
+        :return: (outcome: one of the FETCH_* constants, result_map: dict if outcome is FETCH_OK, else None)
+        """
         json_body = None
         try:
-            json_body = requests.get(
-                'http://94.gaokao.southcn.com/?c=core&a=call&_m=gaokao.search&zkzh=%s&csrq=%s&code=%s&t=%s'
-                % (sid, ymob, code, t)).json()
+            json_body = self._session.get(SouthDataService.query_url,
+                                          params={'zkzh': sid, 'csrq': ymob, 'code': code, 't': t},
+                                          timeout=self.request_timeout).json()
         except Exception as ex:
             self._logger.error('Error occurred fetching data for %s, %s, %s, %s: %s', sid, ymob, code, t, ex)
-            raise RuntimeError
+            return FETCH_FAILED, None
         status = json_body['code']
         if status == -4:
-            raise SouthDataService.InvalidYMOBException()
+            return FETCH_INVALID_YMOB, None
         elif status == 1:
-            return self._parse_json(json_body, ymob)
+            return FETCH_OK, self._parse_json(json_body, ymob)
         elif status == -2:
-            raise SouthDataService.InvalidCaptchaException()
+            return FETCH_INVALID_CAPTCHA, None
         elif status == -3:
-            raise SouthDataService.InvalidSIDException()
+            return FETCH_INVALID_SID, None
         else:
             raise UnknownResponseException(json_body)
         
@@ -460,6 +563,7 @@ class SouthDataService(AbstractDataService):
     def _fetch(self, query_set: Iterable):
         if not self._running:
             return
+        debug = self._logger.isEnabledFor(logging.DEBUG)
         code, t = self._captcha_service.get_captcha_result()
         q_sid = None
         for i, (sid, ymob) in enumerate(query_set):
@@ -472,25 +576,37 @@ class SouthDataService(AbstractDataService):
                     if not captcha_valid:
                         code, t = self._captcha_service.get_captcha_result()
                         captcha_valid = True
-                    self._logger.debug('Trying to fetch: %s, %s, %s, %s', sid, ymob, code, t)
-                    result_map = self._fetch0(sid, ymob, code, t)
-                    self._add_result(result_map)
-                    self._logger.info('Successfully added entry: %s', result_map)
-                    return
-                except SouthDataService.InvalidYMOBException:
-                    self._logger.debug('Invalid YMOB: %s, %s', sid, ymob)
-                    skip = True
-                except SouthDataService.InvalidSIDException:
-                    self._logger.warning('Invalid SID: %s', sid)
-                    return
-                except SouthDataService.InvalidCaptchaException:
-                    self._logger.debug('Invalid captcha: %s, %s', code, t)
-                    captcha_valid = False
-                except RuntimeError:
-                    self._logger.info('Re-adding task for %s, %s', sid, ymob)
-                    future = self._thread_pool_executor.submit(self._fetch, query_set)
-                    self._futures.append(future)
-                    return
+                    if debug:
+                        self._logger.debug('Trying to fetch: %s, %s, %s, %s', sid, ymob, code, t)
+                    outcome, result_map = self._fetch0(sid, ymob, code, t)
+                    if outcome == FETCH_OK:
+                        self._add_result(result_map)
+                        self._logger.info('Successfully added entry: %s', utils.DataStructureHelper.dump_result_map(result_map))
+                        return
+                    elif outcome == FETCH_INVALID_YMOB:
+                        if debug:
+                            self._logger.debug('Invalid YMOB: %s, %s', sid, ymob)
+                        skip = True
+                    elif outcome == FETCH_INVALID_SID:
+                        self._logger.warning('Invalid SID: %s', sid)
+                        return
+                    elif outcome == FETCH_INVALID_CAPTCHA:
+                        if debug:
+                            self._logger.debug('Invalid captcha: %s, %s', code, t)
+                        captcha_valid = False
+                    else:  # FETCH_FAILED
+                        if not self._running:
+                            return
+                        if self._is_single_query_set(query_set):
+                            self._logger.info('Retrying %s, %s', sid, ymob)
+                            time.sleep(self.retry_delay)
+                            continue
+                        self._logger.info('Re-adding task for %s, %s', sid, ymob)
+                        try:
+                            self._submit(self._fetch, query_set)
+                        except RuntimeError:  # The executor has been shut down in the meantime
+                            self._logger.warning('DataService stopped; dropping task for %s, %s', sid, ymob)
+                        return
                 except Exception:
                     self._logger.exception('Error fetching or adding data')
         self._logger.warning('No valid YMOB for SID %s', q_sid)
@@ -1,10 +1,14 @@
+import atexit
 import logging.config
 import logging.handlers
+import queue
 import sys
 from datetime import datetime
 
 # Setup logging module
 
+log_queue = queue.Queue()  # File records go through this queue so that worker threads never wait on disk writes
+
 cfg = {
     'version': 1,
     'formatters': {
@@ -20,10 +24,10 @@ cfg = {
             'stream': sys.stdout
         },
         'file': {
-            'class': 'logging.FileHandler',
-            'formatter': 'default',
+            # No formatter here: records are formatted by the file handler on the listener's thread
+            '()': logging.handlers.QueueHandler,
             'level': 'DEBUG',
-            'filename': 'logs/' + datetime.strftime(datetime.now(), '%Y%m%d%H%M%S.%f')[:-3] + '.log'
+            'queue': log_queue
         }
     },
     'root': {
@@ -39,3 +43,9 @@ cfg = {
 logging.config.dictConfig(cfg)
 logging.getLogger('requests').setLevel(logging.WARNING)
 logging.getLogger('urllib3').setLevel(logging.WARNING)
+
+file_handler = logging.FileHandler('logs/' + datetime.strftime(datetime.now(), '%Y%m%d%H%M%S.%f')[:-3] + '.log')
+file_handler.setFormatter(logging.Formatter(cfg['formatters']['default']['format']))
+queue_listener = logging.handlers.QueueListener(log_queue, file_handler)
+queue_listener.start()
+atexit.register(queue_listener.stop)  # Flushes the records left in the queue
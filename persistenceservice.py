@@ -22,6 +22,19 @@ class AbstractPersistenceService(metaclass=ABCMeta):
     def stop(self):
         pass
     
+    @staticmethod
+    def _write_csv(filename, encoding, rows) -> None:
+        """
+        Writes rows to a CSV file, creating its directory if needed. Rows go through a 1 MiB buffer, so even large
+        outputs take few write calls.
+        """
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(filename, mode='w', encoding=encoding, newline='', buffering=1 << 20) as fle:
+            writer = csv.writer(fle)
+            writer.writerows(rows)
+    
     
 class CSVEnrollmentPersistenceService(AbstractPersistenceService):
     
@@ -33,13 +46,7 @@ class CSVEnrollmentPersistenceService(AbstractPersistenceService):
     def output(self):
         rows = utils.OutputHelper.output_rows(self._results, utils.EnrollmentFieldsHelper.get_output_fields(),
                                               utils.EnrollmentFieldsHelper.get_output_field_names())
-        try:
-            os.makedirs(os.path.dirname(self._filename), exist_ok=True)
-        except FileNotFoundError:
-            pass
-        with open(self._filename, mode='w', encoding=self._encoding) as fle:
-            writer = csv.writer(fle)
-            writer.writerows(rows)
+        self._write_csv(self._filename, self._encoding, rows)
                 
     def start(self):
         # This type of persistence service has no need to continuously get data
@@ -66,30 +73,24 @@ class CSVPersistenceService(AbstractPersistenceService):
         
     def output(self):
         rows = utils.OutputHelper.output_rows(self._results, utils.FieldsHelper.get_output_fields(), utils.FieldsHelper.get_output_field_names())
-        try:
-            os.makedirs(os.path.dirname(self._filename), exist_ok=True)
-        except FileNotFoundError:
-            pass
-        with open(self._filename, mode='w', encoding=self._encoding) as fle:
-            writer = csv.writer(fle)
-            writer.writerows(rows)
+        self._write_csv(self._filename, self._encoding, rows)
     
     def process(self):
+        major_groups = utils.RankingHelper.group_results(self._results, 'major')
         if self._rank:
-            for key in utils.FieldsHelper.rankable_fields:
-                for major in utils.FieldsHelper.major_list:
-                    utils.RankingHelper.rank_column(self._results, key, utils.FieldsHelper.wrap_rank(key),
-                                                    range_controller=lambda x: x['major'] == major)
+            for major in utils.FieldsHelper.major_list:
+                major_results = major_groups.get(major, [])
+                for key in utils.FieldsHelper.rankable_fields:
+                    utils.RankingHelper.rank_result_list(major_results, key, utils.FieldsHelper.wrap_rank(key))
             for key in utils.FieldsHelper.cross_rankable_fields:
-                utils.RankingHelper.rank_column(self._results, key, utils.FieldsHelper.wrap_cross_rank(key))
+                utils.RankingHelper.rank_result_list(self._results, key, utils.FieldsHelper.wrap_cross_rank(key))
         
         if self._avg:
-            for key in utils.FieldsHelper.rankable_fields:
-                for major in utils.FieldsHelper.major_list:
-                    utils.RankingHelper.average(self._results, key, utils.FieldsHelper.wrap_avg(key),
-                                                range_controller=lambda x: x['major'] == major and x[key] != -1)
-            for key in utils.FieldsHelper.cross_rankable_fields:
-                utils.RankingHelper.average(self._results, key, utils.FieldsHelper.wrap_cross_avg(key), range_controller=lambda x: x[key] != -1)
+            for major in utils.FieldsHelper.major_list:
+                utils.RankingHelper.average_columns(major_groups.get(major, []), utils.FieldsHelper.rankable_fields,
+                                                    utils.FieldsHelper.wrap_avg)
+            utils.RankingHelper.average_columns(self._results, utils.FieldsHelper.cross_rankable_fields,
+                                                utils.FieldsHelper.wrap_cross_avg)
     
     def start(self):
         # This type of persistence service has no need to continuously get data
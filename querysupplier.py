@@ -1,5 +1,6 @@
 import logging
 import csv
+import itertools
 import utils
 from abc import abstractmethod
 from abc import ABCMeta
@@ -29,30 +30,29 @@ class LocalQuerySupplier(AbstractQuerySupplier):
         self._files = files
         self._encoding = encoding
         self._initiated = False
-        self._query_sets = set()
+        self._queries = set()  # Flat (sid, ymob) pairs; wrapped into query sets only when handed out
         
     def _parse_csv_file(self, fle):
         # TODO: extract file parser functions
         self._logger.info('Parsing csv file %s', fle.name)
         reader = csv.reader(fle)
-        rows = [x for x in reader]
-        column_names = rows[0]
-        column_names = [utils.FieldsHelper.get_field_key_by_name(x) for x in column_names]
+        column_names = [utils.FieldsHelper.get_field_key_by_name(x) for x in next(reader, [])]
         self._logger.debug('Columns in csv file %s: %s', fle.name, column_names)
-        data_rows = rows[1:]
-        for line_i, row in enumerate(data_rows):
-            line_no = line_i + 1
+        if 'sid' not in column_names or 'ymob' not in column_names:
+            self._logger.error('No sid or ymob column in csv file %s: %s', fle.name, column_names)
+            return
+        sid_index = column_names.index('sid')
+        ymob_index = column_names.index('ymob')
+        min_row_len = max(sid_index, ymob_index) + 1
+        for line_no, row in enumerate(reader, 1):
             sid, ymob = None, None
-            for ri in range(len(row)):
-                key = column_names[ri]
-                if key == 'sid':
-                    sid = row[ri]
-                elif key == 'ymob':
-                    ymob = row[ri].zfill(4)
+            if len(row) >= min_row_len:
+                sid = row[sid_index]
+                ymob = row[ymob_index].zfill(4)
             if not sid or not ymob:
                 self._logger.error('Failed to extract sid or ymob at %s:%d: %s', fle.name, line_no, row)
             else:
-                self._query_sets.add(((sid, ymob),))  # Pay attention to query set's structure
+                self._queries.add((sid, ymob))
                 self._logger.info('Successfully extracted: %s, %s', sid, ymob)
         
     def get_query_sets(self):
@@ -63,8 +63,10 @@ class LocalQuerySupplier(AbstractQuerySupplier):
                         self._parse_csv_file(fle)
                     else:
                         self._logger.error('Unexpected file type in file %s', filename)
+            self._initiated = True
             
-        return self._query_sets
+        for query in self._queries:
+            yield (query,)  # Each query is a query set of its own
     
     
 class DefaultBruteForceQuerySupplier(AbstractQuerySupplier):
@@ -137,7 +139,8 @@ class DefaultBruteForceQuerySupplier(AbstractQuerySupplier):
     
     @staticmethod
     def _get_query_set_for(sid: str):
-        return ((sid, ymob) for ymob in DefaultBruteForceQuerySupplier.ymob_list)
+        # A C-level iterator: no generator frame is created for each SID
+        return zip(itertools.repeat(sid), DefaultBruteForceQuerySupplier.ymob_list)
     
     def __init__(self, start, stop):
         super().__init__()
@@ -147,5 +150,5 @@ class DefaultBruteForceQuerySupplier(AbstractQuerySupplier):
 
     def get_query_sets(self):
         for i in range(self._start, self._stop):
-            yield DefaultBruteForceQuerySupplier._get_query_set_for('%010d' % i)
+            yield DefaultBruteForceQuerySupplier._get_query_set_for(str(i).zfill(10))
         pass
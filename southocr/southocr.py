@@ -1,24 +1,43 @@
 #! /usr/bin/env python3
 
-import hashlib
+import functools
 import os
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from PIL import Image
 
-STAGE_SEARCHING_FOR_CHAR = 0
-STAGE_PROCESSING_CHAR = 1
+THRESHOLD_TABLE = [1 if x >= 160 else 0 for x in range(256)]  # gray level -> 1 for white, 0 for black
 
-samples = []  # each item: (char_name, data, size)
-sample_hashmap = {}  # use hash comparison to accelerate the process since same chars have same hash
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'samples')
 
-# load all samples
-for root, dirs, files in os.walk('southocr/samples'):
-    for fle in files:
-        img = Image.open(os.path.join(root, fle))
-        px = img.load()
-        sha1 = hashlib.sha1()
-        sha1.update(img.tobytes())
-        samples.append((fle[:1], px, img.size))
-        sample_hashmap[sha1.digest()] = fle[:1]
+
+def black_mask(img):
+    """
+    Converts an image to a boolean array of shape (height, width) which is True where the pixel is black.
+    """
+    return np.asarray(img, dtype=np.uint8) == 0
+
+
+@functools.lru_cache(maxsize=None)
+def _get_samples():
+    """
+    Loads all samples on first use, so that importing this module stays cheap.
+    :return: (sample_buckets, sample_hashmap).
+    sample_buckets: samples grouped by size. key: (width, height); value: (char_names, masks of shape (n, height, width))
+    sample_hashmap: exact match to accelerate the process since same chars have same bytes. key: (size, bytes)
+    """
+    grouped_samples = {}  # key: size; value: list of (char_name, mask)
+    sample_hashmap = {}
+    for root, dirs, files in os.walk(SAMPLES_DIR):
+        for fle in files:
+            img = Image.open(os.path.join(root, fle))
+            grouped_samples.setdefault(img.size, []).append((fle[:1], black_mask(img)))
+            sample_hashmap[(img.size, img.tobytes())] = fle[:1]
+    # Larger buckets first: they are the likeliest to hold a perfect match, which ends the search early
+    sample_buckets = {}
+    for ssize, group in sorted(grouped_samples.items(), key=lambda x: len(x[1]), reverse=True):
+        sample_buckets[ssize] = (tuple(char_name for char_name, _ in group), np.stack([mask for _, mask in group]))
+    return sample_buckets, sample_hashmap
 
 
 def append_to_char_boxes_LR(lst, left, right):
@@ -30,115 +49,74 @@ def append_to_char_boxes_LR(lst, left, right):
         lst.append((left, right))
 
 
-def calculate_similarity(cdata, csize, sdata, ssize):
-    cwidth, cheight = csize  # size: (width, height)
-    swidth, sheight = ssize
-    if csize == ssize:
-        score = 0
-        for x in range(cwidth):
-            for y in range(cheight):
-                cdxy = cdata[x, y]
-                sdxy = sdata[x, y]
-                if cdxy == sdxy:
-                    if cdxy == 0:  # We do not increase score if the pixels are white.
-                        score += 1
-                else:
-                    score -= 1
-        return score
-    else:  # return the highest score obtained among all positions
-        if cwidth > swidth or cheight > sheight: return -100  # This captcha generator does not zoom characters. Hence csize must not exceed ssize.
-        score_list = []
-        for xoffset in range(swidth - cwidth + 1):  # all possible positions on x axis
-            for yoffset in range(sheight - cheight + 1):
-                score = 0
-                for x in range(cwidth):
-                    for y in range(cheight):
-                        cdxy = cdata[x, y]
-                        sdxy = sdata[x, y]
-                        if cdxy == sdxy:
-                            if cdxy == 0:   # We do not do score++ if the pixels are white.
-                                score += 1
-                        else:
-                            score -= 1
-                score_list.append(score)
-        return max(score_list)
+def find_runs(mask):
+    """
+    Finds the runs of True in a 1-D boolean array.
+    Padding the mask with False on both ends makes every run start where the difference is 1 and end (exclusive)
+    where it is -1.
+    :return: (starts, ends) of the runs, as lists of ints
+    """
+    edges = np.diff(np.concatenate(([False], mask, [False])).astype(np.int8))
+    return np.flatnonzero(edges == 1).tolist(), np.flatnonzero(edges == -1).tolist()
+
+
+def calculate_similarities(cdata, sdata):
+    """
+    Scores a char against a bucket of same-size samples.
+    :param cdata: mask of the char, of shape (cheight, cwidth)
+    :param sdata: masks of the samples, of shape (n, sheight, swidth)
+    :return: an array of n scores, or None if the char is larger than the samples
+    """
+    cheight, cwidth = cdata.shape
+    sheight, swidth = sdata.shape[1:]
+    if cwidth > swidth or cheight > sheight: return None  # This captcha generator does not zoom characters. Hence csize must not exceed ssize.
+    # We increase the score for each pixel where both are black(not white), and decrease it for each mismatch.
+    # Chars smaller than the samples are tried at all positions; we keep the highest score.
+    windows = sliding_window_view(sdata, cdata.shape, axis=(1, 2))  # shape: (n, y offsets, x offsets, cheight, cwidth)
+    scores = (windows & cdata).sum(axis=(3, 4)) - (windows ^ cdata).sum(axis=(3, 4))
+    return scores.reshape(len(sdata), -1).max(axis=1)
 
 
 def visual_recognise_char_img(cimg):
-    cdata = cimg.load()
-    csize = cimg.size
-    score_list = []  # Stores score for each possible char. item: (score, char_name)
-    for char_name, sdata, ssize in samples:
-        score_list.append((calculate_similarity(cdata, csize, sdata, ssize), char_name))
-    return max(score_list, key=lambda x: x[0])[1]
+    cdata = black_mask(cimg)
+    perfect_score = int(np.count_nonzero(cdata))  # every black pixel matched and no mismatch
+    best_score = None
+    best_char_name = None
+    sample_buckets, _ = _get_samples()
+    for char_names, sdata in sample_buckets.values():
+        scores = calculate_similarities(cdata, sdata)
+        if scores is None:
+            continue
+        i = int(scores.argmax())
+        if best_score is None or scores[i] > best_score:
+            best_score = scores[i]
+            best_char_name = char_names[i]
+            if best_score == perfect_score:  # No sample can do better
+                break
+    return best_char_name
 
 
 def solve(img):
 
     img = img.convert('L')
-    img = img.point(lambda x: 1 if x >= 160 else 0, mode='1')
+    img = img.point(THRESHOLD_TABLE, mode='1')
 
-    px = img.load()
-    size = img.size
-    img_width = size[0]
-    img_height = size[1]
+    black = black_mask(img)  # shape: (height, width)
 
     char_boxes_LR = []  # left & right
     char_boxes_UL = []  # upper & lower
 
-    stage = STAGE_SEARCHING_FOR_CHAR
-    left = 0
-    right = 0
-
     # We'll first determine the left & right boundary for each char,
     # then the upper & lower.
-    for x in range(img_width):
-        empty_column = True
-        for y in range(img_height):
-            if px[x, y] == 0:  # black
-                empty_column = False
-                if stage == STAGE_SEARCHING_FOR_CHAR:
-                    stage = STAGE_PROCESSING_CHAR
-                    left = x
-                break
-
-        if stage == STAGE_PROCESSING_CHAR:
-            if empty_column:
-                stage = STAGE_SEARCHING_FOR_CHAR
-                right = x
-                append_to_char_boxes_LR(char_boxes_LR, left, right)
-            else:
-                if x == img_width - 1:  # last column
-                    stage = STAGE_SEARCHING_FOR_CHAR
-                    right = img_width
-                    append_to_char_boxes_LR(char_boxes_LR, left, right)
+    # A char spans a run of columns containing black pixels, and within those columns a run of rows.
+    for left, right in zip(*find_runs(black.any(axis=0))):
+        append_to_char_boxes_LR(char_boxes_LR, left, right)
 
     if len(char_boxes_LR) != 4:
         return None
 
-    upper = 0
-    lower = 0
-    stage = STAGE_SEARCHING_FOR_CHAR
     for left, right in char_boxes_LR:
-        for y in range(img_height):
-            empty_row = True
-            for x in range(left, right):
-                if px[x, y] == 0:  # black
-                    empty_row = False
-                    if stage == STAGE_SEARCHING_FOR_CHAR:
-                        stage = STAGE_PROCESSING_CHAR
-                        upper = y
-                    break
-            if stage == STAGE_PROCESSING_CHAR:
-                if empty_row:
-                    stage = STAGE_SEARCHING_FOR_CHAR
-                    lower = y
-                    char_boxes_UL.append((upper, lower))
-                else:
-                    if y == img_height - 1:
-                        stage = STAGE_SEARCHING_FOR_CHAR
-                        lower = img_height
-                        char_boxes_UL.append((upper, lower))
+        char_boxes_UL.extend(zip(*find_runs(black[:, left:right].any(axis=1))))
 
     if len(char_boxes_UL) != 4:
         return None
@@ -149,13 +127,11 @@ def solve(img):
     for (left, right), (upper, lower) in zip(char_boxes_LR, char_boxes_UL):
         char_images.append(img.crop((left, upper, right, lower)))
 
-    # Perform a quick match based on hash
+    # Perform a quick match on the raw bitmap; it is only a few bytes, so it serves as the key itself
+    _, sample_hashmap = _get_samples()
     result_list = []
     for cimg in char_images:
-        sha1 = hashlib.sha1()
-        sha1.update(cimg.tobytes())
-        sha1 = sha1.digest()
-        char_result = sample_hashmap.get(sha1)
+        char_result = sample_hashmap.get((cimg.size, cimg.tobytes()))
         result_list.append(char_result)
 
     # If quick match fails, we would have to perform visual-based recognition
@@ -163,5 +139,7 @@ def solve(img):
         if res: continue
         cimg = char_images[i]
         result_list[i] = visual_recognise_char_img(cimg)
+        if not result_list[i]:  # No sample is large enough for this char
+            return None
 
     return ''.join(result_list)
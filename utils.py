@@ -1,5 +1,11 @@
+import ast
+import json
 import logging
+import requests
 from collections import OrderedDict
+from http.cookiejar import DefaultCookiePolicy
+from typing import Iterator
+from requests.adapters import HTTPAdapter
 
 
 class MultithreadingHelper:
@@ -16,27 +22,77 @@ class MultithreadingHelper:
         return wrapped_func
     
     
+class SessionHelper:
+    
+    request_timeout = (5, 15)  # (connect, read) seconds; a stalled request must not pin a worker thread forever
+    
+    class _RejectAllCookiesPolicy(DefaultCookiePolicy):
+        
+        def set_ok(self, cookie, request):
+            return False
+    
+    @staticmethod
+    def create_session(pool_size: int) -> requests.Session:
+        """
+        Creates a session that keeps up to `pool_size` connections alive per host, so that worker threads can reuse
+        connections instead of opening a new one for every request.
+        Cookies from responses are not stored in the session: every request stays independent, as with requests.get,
+        and cookies that matter (e.g. those bound to a captcha) have to be passed explicitly.
+        :param pool_size: The number of connections to keep per host; normally the number of worker threads
+        :return: The session
+        """
+        session = requests.Session()
+        session.cookies.set_policy(SessionHelper._RejectAllCookiesPolicy())
+        adapter = HTTPAdapter(pool_maxsize=max(pool_size, 1))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+    
+    
 class OutputHelper:
     
     _logger = logging.getLogger(__name__)
     
     @staticmethod
-    def output_rows(entries: list, output_fields: list, output_field_names: list) -> list:
+    def output_rows(entries: list, output_fields: list, output_field_names: list) -> Iterator[list]:
+        """
+        Yields the header and then one row per entry, so that a csv writer can consume them without the whole table
+        being built in memory first.
+        """
         expected_result_len = len(output_fields)
-        rows = [output_field_names]  # Initialise the first line
+        yield list(output_field_names)  # The first line
         for entry in entries:
             entry_len = len(entry)
             if entry_len != expected_result_len:
                 OutputHelper._logger.warning('Wrong length %d(expected %d) in entry: %s', entry_len, expected_result_len, entry)
-            row = []
-            for key in output_fields:
-                row.append(entry.get(key, ''))
-            rows.append(row)
-        return rows
+            get = entry.get
+            yield [get(key, '') for key in output_fields]
     
     
 class DataStructureHelper:
     
+    @staticmethod
+    def dump_result_map(result_map: dict) -> str:
+        """
+        Serialises a result map for the 'Successfully added entry' log records, which LocalDataService reads back.
+        :param result_map: The result map to serialise
+        :return: The result map in JSON
+        """
+        return json.dumps(result_map, ensure_ascii=False)
+    
+    @staticmethod
+    def load_result_map(s: str) -> dict:
+        """
+        Reverses dump_result_map. Also accepts the Python literal format used by logs written before entries were
+        logged in JSON.
+        :param s: The serialised result map
+        :return: The result map
+        """
+        try:
+            return json.loads(s)
+        except ValueError:
+            return ast.literal_eval(s)
+    
     @staticmethod
     def construct_result_map(sid: str, name: str, ymob: str, major: int, chn: int, mth: int, eng: int, com: int, sum: int):
         return {
@@ -146,6 +202,11 @@ class FieldsHelper:
     avg_suffix = '_avg'
     cross_avg_suffix = '_avg_cross'
     
+    # Output fields and their names depend only on (rank, avg); they are built once for each combination.
+    _output_fields_cache = {}
+    _output_field_names_cache = {}
+    _output_field_name_map = {}  # every field, plain or wrapped -> its output name; built on first use
+    
     @staticmethod
     def get_field_key_by_name(name: str):
         return FieldsHelper.basic_field_name_reverse.get(name)
@@ -153,40 +214,36 @@ class FieldsHelper:
     @staticmethod
     def get_output_fields(rank=True, avg=True):
         # This function's return value should have the same order with get_output_field_names
-        lst = []
-        for field, field_name in FieldsHelper.basic_field_names.items():
-            lst.append(field)
-            if rank or avg:
-                if field in FieldsHelper.rankable_fields:
-                    if rank:
-                        lst.append(FieldsHelper.wrap_rank(field))
-                    if avg:
-                        lst.append(FieldsHelper.wrap_avg(field))
-                if field in FieldsHelper.cross_rankable_fields:
-                    if rank:
-                        lst.append(FieldsHelper.wrap_cross_rank(field))
-                    if avg:
-                        lst.append(FieldsHelper.wrap_cross_avg(field))
-        return lst
+        cache_key = (bool(rank), bool(avg))
+        fields = FieldsHelper._output_fields_cache.get(cache_key)
+        if fields is None:
+            lst = []
+            for field, field_name in FieldsHelper.basic_field_names.items():
+                lst.append(field)
+                if rank or avg:
+                    if field in FieldsHelper.rankable_fields:
+                        if rank:
+                            lst.append(FieldsHelper.wrap_rank(field))
+                        if avg:
+                            lst.append(FieldsHelper.wrap_avg(field))
+                    if field in FieldsHelper.cross_rankable_fields:
+                        if rank:
+                            lst.append(FieldsHelper.wrap_cross_rank(field))
+                        if avg:
+                            lst.append(FieldsHelper.wrap_cross_avg(field))
+            fields = FieldsHelper._output_fields_cache[cache_key] = tuple(lst)
+        return fields
     
     @staticmethod
     def get_output_field_names(rank=True, avg=True):
         # This function's return value should have the same order with get_output_fields
-        lst = []
-        for field, field_name in FieldsHelper.basic_field_names.items():
-            lst.append(field_name)
-            if rank or avg:
-                if field in FieldsHelper.rankable_fields:
-                    if rank:
-                        lst.append(FieldsHelper.get_output_field_name(FieldsHelper.wrap_rank(field)))
-                    if avg:
-                        lst.append(FieldsHelper.get_output_field_name(FieldsHelper.wrap_avg(field)))
-                if field in FieldsHelper.cross_rankable_fields:
-                    if rank:
-                        lst.append(FieldsHelper.get_output_field_name(FieldsHelper.wrap_cross_rank(field)))
-                    if avg:
-                        lst.append(FieldsHelper.get_output_field_name(FieldsHelper.wrap_cross_avg(field)))
-        return lst
+        cache_key = (bool(rank), bool(avg))
+        field_names = FieldsHelper._output_field_names_cache.get(cache_key)
+        if field_names is None:
+            field_names = tuple(FieldsHelper.get_output_field_name(field)
+                                for field in FieldsHelper.get_output_fields(rank=rank, avg=avg))
+            FieldsHelper._output_field_names_cache[cache_key] = field_names
+        return field_names
     
     @staticmethod
     def wrap_rank(field):
@@ -206,16 +263,16 @@ class FieldsHelper:
     
     @staticmethod
     def get_output_field_name(field):
-        if field.endswith(FieldsHelper.cross_rank_suffix):
-            return FieldsHelper.basic_field_names[field[: - len(FieldsHelper.cross_rank_suffix)]] + '排名'
-        elif field.endswith(FieldsHelper.rank_suffix):
-            return FieldsHelper.basic_field_names[field[: - len(FieldsHelper.rank_suffix)]] + '科内排名'
-        elif field.endswith(FieldsHelper.cross_avg_suffix):
-            return FieldsHelper.basic_field_names[field[: - len(FieldsHelper.cross_avg_suffix)]] + '平均'
-        elif field.endswith(FieldsHelper.avg_suffix):
-            return FieldsHelper.basic_field_names[field[: - len(FieldsHelper.avg_suffix)]] + '科内平均'
-        else:
-            return FieldsHelper.basic_field_names[field]
+        if not FieldsHelper._output_field_name_map:
+            name_map = {}
+            for basic_field, field_name in FieldsHelper.basic_field_names.items():
+                name_map[basic_field] = field_name
+                name_map[FieldsHelper.wrap_cross_rank(basic_field)] = field_name + '排名'
+                name_map[FieldsHelper.wrap_rank(basic_field)] = field_name + '科内排名'
+                name_map[FieldsHelper.wrap_cross_avg(basic_field)] = field_name + '平均'
+                name_map[FieldsHelper.wrap_avg(basic_field)] = field_name + '科内平均'
+            FieldsHelper._output_field_name_map = name_map
+        return FieldsHelper._output_field_name_map[field]
 
 
 class RankingHelper:
@@ -230,29 +287,24 @@ class RankingHelper:
 
     @staticmethod
     def rank_result_list(lst: list, key_name: str, result_name: str) -> None:
+        # Look every sort key up once; sorting positions by a bound C method avoids running a lambda per result.
+        sort_keys = [result[key_name] if result[key_name] else 0 for result in lst]
         try:
-            lst = sorted(lst, key=lambda result: result[key_name] if result[key_name] else 0, reverse=True)
+            order = sorted(range(len(lst)), key=sort_keys.__getitem__, reverse=True)
         except Exception:
-            pass
+            order = range(len(lst))
         previous_rank = 0
         previous_value = 0
-        for result, index in zip(lst, range(1, len(lst) + 1)):
+        for index, i in enumerate(order, 1):
+            result = lst[i]
             current_value = result[key_name]
-            if not previous_rank:  # Initialise the #1
-                result[result_name] = 1
-                previous_rank = 1
-                previous_value = current_value
-                continue
+            if previous_rank and current_value == previous_value:
+                # Same value, same rank
+                result[result_name] = previous_rank
             else:
-                if current_value == previous_value:
-                    # Same value, same rank
-                    result[result_name] = previous_rank
-                    continue
-                else:
-                    result[result_name] = index
-                    previous_rank = index
-                    previous_value = current_value
-                    continue
+                result[result_name] = index
+                previous_rank = index
+                previous_value = current_value
 
     @staticmethod
     def rank_column(results: list, key_name: str, result_name: str, range_controller=None) -> None:
@@ -269,6 +321,44 @@ class RankingHelper:
         for result in lst:
             result[result_name] = average
 
+    @staticmethod
+    def group_results(results: list, key_name: str) -> dict:
+        """
+        Splits results into lists by their value for a key, in one pass.
+        :return: A dict mapping each value to the list of results having it
+        """
+        groups = {}
+        for result in results:
+            groups.setdefault(result[key_name], []).append(result)
+        return groups
+
+    @staticmethod
+    def average_columns(results: list, key_names, result_name_wrapper, excluded_value=-1, digits=4) -> None:
+        """
+        Averages several columns at once, with one pass to sum and one pass to assign. A result whose value for a key
+        equals `excluded_value` is left out of that key's average and does not get the average assigned.
+        :param key_names: The keys to average
+        :param result_name_wrapper: A function mapping a key to the key under which its average is stored
+        """
+        sums = dict.fromkeys(key_names, 0)
+        counts = dict.fromkeys(key_names, 0)
+        for result in results:
+            for key_name in key_names:
+                value = result[key_name]
+                if value != excluded_value:
+                    sums[key_name] += value if value else 0
+                    counts[key_name] += 1
+        format = '%.{0}f'.format(digits)
+        averages = {
+            key_name: float(format % (float(sums[key_name]) / float(counts[key_name]))) if counts[key_name] else 0
+            for key_name in key_names
+        }
+        result_names = {key_name: result_name_wrapper(key_name) for key_name in key_names}
+        for result in results:
+            for key_name in key_names:
+                if result[key_name] != excluded_value:
+                    result[result_names[key_name]] = averages[key_name]
+
     @staticmethod
     def average(results: list, key_name: str, result_name: str, range_controller=None, digits=4) -> None:
         ranged_results = RankingHelper.ranged_results(results, range_controller=range_controller)